@@ -1,43 +1,23 @@
+import io
 import os
 import csv
 import zipfile
 import sqlite3
 import hashlib
+import operator
+import mmap
 import argparse
+import functools
+import importlib
+import contextlib
 import tempfile
+import itertools
+import collections
 import logging
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
-from typing import Optional
-
-try:
-    import docx
-    HAS_DOCX = True
-except ImportError:
-    HAS_DOCX = False
-    logging.warning("python-docx не установлен, .docx файлы будут пропущены")
-
-try:
-    import openpyxl
-    HAS_XLSX = True
-except ImportError:
-    HAS_XLSX = False
-    logging.warning("openpyxl не установлен, .xlsx файлы будут пропущены")
-
-try:
-    import pdfplumber
-    HAS_PDF = True
-except ImportError:
-    HAS_PDF = False
-    logging.warning("pdfplumber не установлен, .pdf файлы будут пропущены")
-
-try:
-    import py7zr
-    HAS_7Z = True
-except ImportError:
-    HAS_7Z = False
-    logging.warning("py7zr не установлен, .7z архивы будут пропущены")
-
+from typing import BinaryIO, Iterable, Iterator, Optional, Union
 
 logging.basicConfig(
     level=logging.INFO,
@@ -47,19 +27,68 @@ logging.basicConfig(
 log = logging.getLogger(__name__)
 
 
-def parse_txt(path: str) -> str:
-    """Читаем .txt с автодетектом кодировки."""
-    for enc in ("utf-8", "cp1251", "latin-1"):
+# Парсеры тянут тяжёлые зависимости (pdfplumber — pdfminer и Pillow), поэтому
+# импортируем их при первом файле нужного типа, а не при старте скрипта.
+OPTIONAL_MODULES = {
+    "docx":               "python-docx не установлен, .docx файлы будут пропущены",
+    "python_calamine":    "python-calamine не установлен, .xlsx файлы будут разбираться через openpyxl",
+    "openpyxl":           "openpyxl не установлен, .xlsx файлы будут пропущены без python-calamine",
+    "pypdf":              "pypdf не установлен, .pdf файлы будут разбираться через pdfplumber",
+    "pdfplumber":         "pdfplumber не установлен, режим --high-fidelity для .pdf недоступен",
+    "charset_normalizer": "charset_normalizer не установлен, кодировка .txt определяется перебором",
+    "py7zr":              "py7zr не установлен, .7z архивы будут пропущены",
+}
+
+
+@functools.lru_cache(maxsize=None)
+def optional_module(name: str):
+    """Модуль из OPTIONAL_MODULES или None, если он не установлен."""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        log.warning(OPTIONAL_MODULES[name])
+        return None
+
+
+# Кодировку угадываем по началу файла — этого хватает и стоит копейки.
+CHARSET_SAMPLE_SIZE = 4096
+
+
+def decode_text(data: bytes) -> str:
+    """
+    Декодируем байты: сначала UTF-8 (с BOM или без), затем кодировка,
+    найденная charset_normalizer по началу файла, затем cp1251 и latin-1.
+    """
+    try:
+        return data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        pass
+
+    charset_normalizer = optional_module("charset_normalizer")
+    if charset_normalizer is not None:
+        best = charset_normalizer.from_bytes(data[:CHARSET_SAMPLE_SIZE]).best()
+        if best is not None:
+            try:
+                return data.decode(best.encoding)
+            except (UnicodeDecodeError, LookupError):
+                pass
+
+    for enc in ("cp1251", "latin-1"):
         try:
-            with open(path, "r", encoding=enc) as f:
-                return f.read()
+            return data.decode(enc)
         except UnicodeDecodeError:
             continue
     return ""
 
 
-def parse_docx(path: str) -> str:
-    if not HAS_DOCX:
+def parse_txt(path: str) -> str:
+    """Читаем .txt с автодетектом кодировки — файл читается с диска один раз."""
+    return decode_text(Path(path).read_bytes())
+
+
+def parse_docx(path: Union[str, BinaryIO]) -> str:
+    docx = optional_module("docx")
+    if docx is None:
         return ""
     try:
         doc = docx.Document(path)
@@ -69,8 +98,31 @@ def parse_docx(path: str) -> str:
         return ""
 
 
-def parse_xlsx(path: str) -> str:
-    if not HAS_XLSX:
+def parse_xlsx_calamine(path: Union[str, BinaryIO]) -> str:
+    """Значения ячеек через calamine (Rust) — в разы быстрее openpyxl."""
+    try:
+        wb = optional_module("python_calamine").CalamineWorkbook.from_object(path)
+        parts = []
+        for sheet in wb.sheet_names:
+            for row in wb.get_sheet_by_name(sheet).to_python():
+                # calamine отдаёт числа как float, а пустые ячейки как "".
+                row_str = " | ".join(
+                    str(int(c)) if isinstance(c, float) and c.is_integer() else str(c)
+                    for c in row if c is not None and c != ""
+                )
+                if row_str.strip():
+                    parts.append(row_str)
+        return "\n".join(parts)
+    except Exception as e:
+        log.warning(f"Ошибка парсинга xlsx {path}: {e}")
+        return ""
+
+
+def parse_xlsx(path: Union[str, BinaryIO]) -> str:
+    if optional_module("python_calamine") is not None:
+        return parse_xlsx_calamine(path)
+    openpyxl = optional_module("openpyxl")
+    if openpyxl is None:
         return ""
     try:
         wb = openpyxl.load_workbook(path, data_only=True, read_only=True)
@@ -88,8 +140,48 @@ def parse_xlsx(path: str) -> str:
         return ""
 
 
-def parse_pdf(path: str) -> str:
-    if not HAS_PDF:
+# Большие PDF режем на диапазоны страниц и разбираем в отдельных процессах.
+# Потоки не подходят: извлечение текста в pypdf упирается в GIL, а PdfReader
+# не потокобезопасен. Так делает и воркер пула файлов (с Python 3.9 его
+# процессы могут заводить свои пулы): больших PDF немного, а без этого
+# один такой файл разбирался бы на одном ядре дольше всего остального обхода.
+PDF_PARALLEL_MIN_PAGES = 64
+PDF_PAGE_WORKERS = 4
+
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> list[str]:
+    reader = optional_module("pypdf").PdfReader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+def parse_pdf(path: Union[str, BinaryIO]) -> str:
+    """Быстрое извлечение текста через pypdf — без построения разметки страницы."""
+    pypdf = optional_module("pypdf")
+    if pypdf is None:
+        return parse_pdf_plumber(path)
+    try:
+        reader = pypdf.PdfReader(path)
+        n_pages = len(reader.pages)
+        # Файловый объект (член архива) по процессам не раздаём.
+        if n_pages < PDF_PARALLEL_MIN_PAGES or not isinstance(path, str):
+            return "\n".join(p.extract_text() or "" for p in reader.pages)
+
+        workers = min(PDF_PAGE_WORKERS, os.cpu_count() or 1)
+        step = -(-n_pages // workers)
+        starts = range(0, n_pages, step)
+        stops = [min(start + step, n_pages) for start in starts]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunks = executor.map(extract_pdf_pages, itertools.repeat(path), starts, stops)
+            return "\n".join(itertools.chain.from_iterable(chunks))
+    except Exception as e:
+        log.warning(f"Ошибка парсинга pdf {path}: {e}")
+        return ""
+
+
+def parse_pdf_plumber(path: Union[str, BinaryIO]) -> str:
+    """Медленнее parse_pdf, но точнее на сложной вёрстке (--high-fidelity)."""
+    pdfplumber = optional_module("pdfplumber")
+    if pdfplumber is None:
         return ""
     try:
         with pdfplumber.open(path) as pdf:
@@ -114,110 +206,425 @@ PARSERS = {
 }
 
 
-def extract_text(filepath: str) -> Optional[str]:
+HIGH_FIDELITY_PARSERS = {
+    ".pdf": parse_pdf_plumber,
+}
+
+
+def get_parser(ext: str, high_fidelity: bool = False):
+    return (high_fidelity and HIGH_FIDELITY_PARSERS.get(ext)) or PARSERS.get(ext)
+
+
+def extract_text(filepath: str, high_fidelity: bool = False) -> Optional[str]:
     ext = Path(filepath).suffix.lower()
-    parser = PARSERS.get(ext)
+    parser = get_parser(ext, high_fidelity)
     if parser is None:
         return None
     return parser(filepath)
 
 
+def extract_member_text(name: str, data: bytes, high_fidelity: bool = False) -> Optional[str]:
+    """Текст члена архива прямо из памяти, без распаковки на диск."""
+    ext = Path(name).suffix.lower()
+    parser = get_parser(ext, high_fidelity)
+    if parser is None:
+        return None
+    if parser is parse_txt:
+        return decode_text(data)
+    return parser(io.BytesIO(data))
+
+
+HASH_ALGORITHM = "sha256"
+HASH_HEX_LENGTH = hashlib.new(HASH_ALGORITHM).digest_size * 2
+HASH_BUFFER_SIZE = 2 * 1024 * 1024
+# Файлы меньше порога хэшируем целиком через mmap, без цикла чтения.
+HASH_SINGLE_SHOT_THRESHOLD = 8 * 1024 * 1024
+
+
 def file_hash(path: str) -> str:
-    h = hashlib.md5()
+    """SHA-256 содержимого файла (OpenSSL использует SHA-NI, где он есть)."""
+    h = hashlib.new(HASH_ALGORITHM)
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            h.update(chunk)
+        size = os.fstat(f.fileno()).st_size
+        if 0 < size < HASH_SINGLE_SHOT_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(mm)
+            return h.hexdigest()
+
+        # Подсказка ядру читать вперёд: файл идёт строго последовательно.
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buf = bytearray(HASH_BUFFER_SIZE)
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            h.update(view[:n])
     return h.hexdigest()
 
 
 
-def unpack_zip(archive_path: str, dest_dir: str):
-    with zipfile.ZipFile(archive_path, "r") as zf:
-        zf.extractall(dest_dir)
+def unpack_7z(archive: Union[str, BinaryIO], dest_dir: str):
+    py7zr = optional_module("py7zr")
+    if py7zr is None:
+        return
+    with py7zr.SevenZipFile(archive, mode="r") as sz:
+        sz.extractall(path=dest_dir)
+
+
+def zip_member_modified(info: zipfile.ZipInfo, archive_label: str) -> str:
+    """
+    Дата члена архива. Некоторые архиваторы пишут нулевую DOS-дату
+    (1980-00-00), на которой datetime падает, — тогда берём mtime
+    самого архива на диске.
+    """
+    try:
+        return datetime(*info.date_time).isoformat()
+    except ValueError:
+        pass
+    try:
+        return modified_iso(os.stat(archive_label))
+    except OSError:
+        return datetime.now().isoformat()
 
 
-def unpack_7z(archive_path: str, dest_dir: str):
-    if not HAS_7Z:
-        log.warning("py7zr не установлен, пропускаем .7z")
+def iter_zip(archive_path: str, archive_label: str, db_path: Optional[str] = None,
+             high_fidelity: bool = False,
+             fileobj: Optional[BinaryIO] = None) -> Iterator[dict]:
+    """
+    Читаем члены zip-архива прямо из памяти, без распаковки во временную
+    директорию. Вложенные архивы разбираем рекурсивно так же.
+    """
+    try:
+        zf = zipfile.ZipFile(fileobj or archive_path, "r")
+    except (zipfile.BadZipFile, OSError) as e:
+        log.warning(f"Не удалось распаковать {archive_path}: {e}")
         return
-    with py7zr.SevenZipFile(archive_path, mode="r") as sz:
-        sz.extractall(path=dest_dir)
 
+    seen_hashes: set[str] = set()
+    cache = open_cache(db_path)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(zf)
+        if cache is not None:
+            stack.callback(cache.close)
+
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            fname = os.path.basename(info.filename)
+            ext = Path(fname).suffix.lower()
+            if ext not in SUPPORTED_EXTS:
+                continue
+
+            member_path = os.path.join(archive_path, info.filename)
+            try:
+                data = zf.read(info)
+            except Exception as e:
+                log.warning(f"Не удалось прочитать {member_path}: {e}")
+                continue
+
+            if ext in ARCHIVE_EXTS:
+                log.info(f"Архив: {member_path}")
+                yield from process_archive(member_path, parent_archive=archive_label,
+                                           db_path=db_path, high_fidelity=high_fidelity,
+                                           fileobj=io.BytesIO(data))
+                continue
+
+            fhash = hashlib.new(HASH_ALGORITHM, data).hexdigest()
+            if fhash in seen_hashes:
+                log.debug(f"Дубликат пропущен: {member_path}")
+                continue
+            seen_hashes.add(fhash)
+
+            text = cached_by_hash(cache, fhash) if cache else None
+            if text is None:
+                text = extract_member_text(fname, data, high_fidelity)
+                if text is None:
+                    continue
+                log.info(f"Обработан: {fname} ({len(text)} символов)")
+
+            yield make_record(member_path, fname, ext, info.file_size,
+                              zip_member_modified(info, archive_label),
+                              archive_label, text, fhash)
 
-def process_archive(archive_path: str, parent_archive: str = "") -> list[dict]:
-    records = []
+
+def process_archive(archive_path: str, parent_archive: str = "",
+                    db_path: Optional[str] = None,
+                    high_fidelity: bool = False,
+                    fileobj: Optional[BinaryIO] = None) -> Iterator[dict]:
     ext = Path(archive_path).suffix.lower()
+    archive_label = parent_archive or archive_path
+
+    if ext == ".zip":
+        yield from iter_zip(archive_path, archive_label, db_path=db_path,
+                            high_fidelity=high_fidelity, fileobj=fileobj)
+        return
 
     with tempfile.TemporaryDirectory() as tmpdir:
         try:
-            if ext == ".zip":
-                unpack_zip(archive_path, tmpdir)
-            elif ext == ".7z":
-                unpack_7z(archive_path, tmpdir)
+            if ext == ".7z":
+                unpack_7z(fileobj or archive_path, tmpdir)
             else:
-                return records
+                return
         except Exception as e:
             log.warning(f"Не удалось распаковать {archive_path}: {e}")
-            return records
+            return
 
-        archive_label = parent_archive or archive_path
-        for r in crawl_directory(tmpdir, archive_label=archive_label):
+        for r in crawl_directory(tmpdir, archive_label=archive_label,
+                                 db_path=db_path, high_fidelity=high_fidelity):
             r["source_archive"] = archive_label
-            records.append(r)
-
-    return records
+            yield r
 
 
 ARCHIVE_EXTS = {".zip", ".7z", ".rar"}
 SUPPORTED_EXTS = set(PARSERS.keys()) | ARCHIVE_EXTS
 
 
-def crawl_directory(root: str, archive_label: str = "") -> list[dict]:
-    records = []
-    seen_hashes: set[str] = set()
+# Меньше этого числа файлов пул процессов не поднимаем — накладные расходы
+# на запуск воркеров съедают выигрыш.
+PARALLEL_MIN_FILES = 8
+# Хэширование упирается в диск, а hashlib и read отпускают GIL — хватает потоков.
+HASH_WORKERS = 4
+# Сколько файлов одновременно может ждать парсинга: ограничивает память
+# под ещё не отданные тексты.
+PIPELINE_DEPTH = 64
 
-    for dirpath, _, filenames in os.walk(root):
-        for fname in filenames:
-            fpath = os.path.join(dirpath, fname)
-            ext = Path(fname).suffix.lower()
 
-            if ext not in SUPPORTED_EXTS:
-                continue
+# Сколько файлов потоки хэширования могут обогнать основной цикл. Байты
+# небольших текстовых файлов живут в памяти до разбора, поэтому окно малое.
+HASH_WINDOW = 16
 
-            if ext in ARCHIVE_EXTS:
-                log.info(f"Архив: {fpath}")
-                sub_records = process_archive(fpath, parent_archive=fpath)
-                records.extend(sub_records)
-                continue
+TEXT_EXTS = {ext for ext, parser in PARSERS.items() if parser is parse_txt}
 
-            try:
-                fhash = file_hash(fpath)
-            except OSError:
-                continue
 
+def hash_for_parse(fpath: str, ext: str, size: int) -> tuple[Optional[str], Optional[bytes]]:
+    """
+    Хэш файла. Небольшие текстовые файлы читаем целиком и отдаём байты
+    вместе с хэшем — второй раз для парсинга файл не открывается.
+    """
+    try:
+        if ext in TEXT_EXTS and size < HASH_SINGLE_SHOT_THRESHOLD:
+            data = Path(fpath).read_bytes()
+            return hashlib.new(HASH_ALGORITHM, data).hexdigest(), data
+        return file_hash(fpath), None
+    except OSError:
+        return None, None
+
+
+def bounded_map(executor: Executor, fn, *iterables, window: int) -> Iterator:
+    """executor.map, но не больше window задач в работе одновременно."""
+    pending: collections.deque = collections.deque()
+    for args in zip(*iterables):
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def open_cache(db_path: Optional[str]) -> Optional[sqlite3.Connection]:
+    """
+    Открываем базу прошлого запуска только на чтение. Если базы или
+    таблицы documents ещё нет — кэша нет.
+    """
+    if not db_path or not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA query_only=ON")
+    has_table = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='documents'"
+    ).fetchone()
+    if not has_table:
+        conn.close()
+        return None
+    return conn
+
+
+def modified_iso(stat: os.stat_result) -> str:
+    return datetime.fromtimestamp(stat.st_mtime).isoformat()
+
+
+def cached_by_stat(cache: sqlite3.Connection, fpath: str,
+                   stat: os.stat_result) -> Optional[tuple[str, str]]:
+    """
+    (file_hash, content) для файла, не менявшегося с прошлого запуска.
+    Строки с хэшем старого формата (MD5) не подходят: файл перечитаем,
+    чтобы в базу попал хэш по HASH_ALGORITHM.
+    """
+    return cache.execute("""
+        SELECT d.file_hash, f.content
+        FROM documents d
+        JOIN documents_fts f ON f.rowid = d.id
+        WHERE d.file_path = ? AND d.size_bytes = ? AND d.modified_at = ?
+          AND length(d.file_hash) = ?
+        LIMIT 1
+    """, (fpath, stat.st_size, modified_iso(stat), HASH_HEX_LENGTH)).fetchone()
+
+
+def cached_by_hash(cache: sqlite3.Connection, fhash: str) -> Optional[str]:
+    row = cache.execute("""
+        SELECT f.content
+        FROM documents d
+        JOIN documents_fts f ON f.rowid = d.id
+        WHERE d.file_hash = ?
+    """, (fhash,)).fetchone()
+    return row[0] if row else None
+
+
+def make_record(fpath: str, fname: str, ext: str, size: int, modified_at: str,
+                archive_label: str, text: str, fhash: str) -> dict:
+    return {
+        "file_path":      fpath,
+        "file_name":      fname,
+        "extension":      ext.lstrip("."),
+        "size_bytes":     size,
+        "modified_at":    modified_at,
+        "source_archive": archive_label,
+        "content":        text.strip(),
+        "file_hash":      fhash,
+    }
+
+
+def file_ext(fname: str) -> str:
+    """То же, что Path(fname).suffix.lower(), но без создания Path на каждый файл."""
+    i = fname.rfind(".")
+    return fname[i:].lower() if 0 < i < len(fname) - 1 else ""
+
+
+def scan(root: str) -> Iterator[os.DirEntry]:
+    """
+    Обходим дерево через os.scandir: тип записи берётся из DirEntry, а её
+    stat() кэшируется и дальше используется для размера и mtime.
+    Симлинки на директории не раскрываем — как os.walk по умолчанию.
+    """
+    stack = [root]
+    while stack:
+        dirpath = stack.pop()
+        subdirs = []
+        try:
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file():
+                            yield entry
+                    except OSError:
+                        continue
+        except OSError as e:
+            log.warning(f"Не удалось прочитать директорию {dirpath}: {e}")
+            continue
+        stack.extend(reversed(subdirs))
+
+
+def crawl_directory(root: str, archive_label: str = "",
+                    db_path: Optional[str] = None,
+                    high_fidelity: bool = False) -> Iterator[dict]:
+    """
+    Отдаём записи по одной, чтобы не держать весь корпус в памяти.
+
+    Если передан db_path, база прошлого запуска служит кэшем: файлы с
+    теми же путём, размером и mtime не читаются вовсе, а файлы с уже
+    известным хэшем не парсятся повторно.
+
+    high_fidelity включает медленные, но точные парсеры (pdfplumber для .pdf).
+    """
+    files = []
+
+    for entry in scan(root):
+        fpath, fname = entry.path, entry.name
+        ext = file_ext(fname)
+
+        if ext not in SUPPORTED_EXTS:
+            continue
+
+        if ext in ARCHIVE_EXTS:
+            log.info(f"Архив: {fpath}")
+            yield from process_archive(fpath, parent_archive=fpath, db_path=db_path,
+                                       high_fidelity=high_fidelity)
+            continue
+
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        files.append((fpath, fname, ext, stat))
+
+    cache = open_cache(db_path)
+
+    with contextlib.ExitStack() as stack:
+        if cache is not None:
+            stack.callback(cache.close)
+
+        # Сначала кэш по пути, размеру и mtime: такие файлы не открываем.
+        seen_hashes: set[str] = set()
+        to_hash = []
+        for fpath, fname, ext, stat in files:
+            hit = cached_by_stat(cache, fpath, stat) if cache else None
+            if hit:
+                fhash, text = hit
+                seen_hashes.add(fhash)
+                log.debug(f"Без изменений: {fpath}")
+                yield make_record(fpath, fname, ext, stat.st_size, modified_iso(stat),
+                                  archive_label, text, fhash)
+                continue
+            to_hash.append((fpath, fname, ext, stat))
+
+        hash_pool = stack.enter_context(ThreadPoolExecutor(max_workers=HASH_WORKERS))
+        if len(to_hash) >= PARALLEL_MIN_FILES:
+            parse_pool = stack.enter_context(ProcessPoolExecutor(max_workers=os.cpu_count()))
+        else:
+            parse_pool = stack.enter_context(ThreadPoolExecutor(max_workers=1))
+
+        # Конвейер: потоки хэшируют файлы впереди, а каждый готовый хэш,
+        # которого нет в кэше, сразу уходит на парсинг в пул процессов.
+        # Дубликаты отсеиваем здесь же по полному хэшу — до парсинга.
+        parse = functools.partial(extract_text, high_fidelity=high_fidelity)
+        pending: collections.deque = collections.deque()
+        hashes = bounded_map(hash_pool, hash_for_parse,
+                             [item[0] for item in to_hash],
+                             [item[2] for item in to_hash],
+                             [item[3].st_size for item in to_hash],
+                             window=HASH_WINDOW)
+        for (fpath, fname, ext, stat), (fhash, data) in zip(to_hash, hashes):
+            if fhash is None:
+                continue
             if fhash in seen_hashes:
                 log.debug(f"Дубликат пропущен: {fpath}")
                 continue
             seen_hashes.add(fhash)
 
-            text = extract_text(fpath)
-            if text is None:
+            text = cached_by_hash(cache, fhash) if cache else None
+            if text is not None:
+                log.debug(f"Содержимое уже в базе: {fpath}")
+                yield make_record(fpath, fname, ext, stat.st_size, modified_iso(stat),
+                                  archive_label, text, fhash)
                 continue
 
-            stat = os.stat(fpath)
-            records.append({
-                "file_path":      fpath,
-                "file_name":      fname,
-                "extension":      ext.lstrip("."),
-                "size_bytes":     stat.st_size,
-                "modified_at":    datetime.fromtimestamp(stat.st_mtime).isoformat(),
-                "source_archive": archive_label,
-                "content":        text.strip(),
-                "file_hash":      fhash,
-            })
-            log.info(f"Обработан: {fname} ({len(text)} символов)")
+            if data is not None:
+                text = decode_text(data)
+                log.info(f"Обработан: {fname} ({len(text)} символов)")
+                yield make_record(fpath, fname, ext, stat.st_size, modified_iso(stat),
+                                  archive_label, text, fhash)
+                continue
+
+            pending.append(((fpath, fname, ext, stat, fhash), parse_pool.submit(parse, fpath)))
+            if len(pending) >= PIPELINE_DEPTH:
+                yield from build_parsed(pending.popleft(), archive_label)
+
+        while pending:
+            yield from build_parsed(pending.popleft(), archive_label)
 
-    return records
+
+def build_parsed(task: tuple[tuple[str, str, str, os.stat_result, str], Future],
+                 archive_label: str) -> Iterator[dict]:
+    (fpath, fname, ext, stat, fhash), future = task
+    text = future.result()
+    if text is None:
+        return
+    log.info(f"Обработан: {fname} ({len(text)} символов)")
+    yield make_record(fpath, fname, ext, stat.st_size, modified_iso(stat),
+                      archive_label, text, fhash)
 
 
 FIELDNAMES = [
@@ -226,71 +633,300 @@ FIELDNAMES = [
     "content", "file_hash",
 ]
 
+# Строка CSV из записи одним C-вызовом вместо цикла по FIELDNAMES.
+csv_row = operator.itemgetter(*FIELDNAMES)
 
-def save_csv(records: list[dict], output_path: str):
+
+def iter_csv(records: Iterable[dict], output_path: str) -> Iterator[dict]:
+    """Пишем записи в CSV по мере поступления и отдаём их дальше по конвейеру."""
     os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    count = 0
     with open(output_path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
-        writer.writeheader()
-        writer.writerows(records)
-    log.info(f"CSV сохранён: {output_path} ({len(records)} записей)")
+        writer = csv.writer(f)
+        writer.writerow(FIELDNAMES)
+        for r in records:
+            writer.writerow(csv_row(r))
+            count += 1
+            yield r
+    log.info(f"CSV сохранён: {output_path} ({count} записей)")
+
+
+def save_csv(records: Iterable[dict], output_path: str):
+    for _ in iter_csv(records, output_path):
+        pass
+
+
+
+SQLITE_BATCH_SIZE = 1000
 
+# Текст документа хранится только в documents_fts, в documents — метаданные.
+DOCUMENT_COLUMNS = [f for f in FIELDNAMES if f != "content"]
+document_row = operator.itemgetter(*DOCUMENT_COLUMNS)
+
+# remove_diacritics 2 снимает диакритику только с латиницы (café → cafe),
+# кириллические «ё» и «й» остаются как есть. Префиксные индексы ускоряют
+# запросы вида term*.
+FTS_TOKENIZE = "'porter unicode61 remove_diacritics 2'"
+FTS_PREFIX = "'2 3 4'"
+
+SQLITE_INDEXES = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_documents_hash ON documents(file_hash)",
+    "CREATE INDEX IF NOT EXISTS ix_documents_path ON documents(file_path)",
+)
+
+# Крупные страницы — меньше уровней B-дерева и промахов кэша на большом
+# FTS-индексе.
+SQLITE_PAGE_SIZE = 65536
+
+SQLITE_PRAGMAS = (
+    f"PRAGMA page_size={SQLITE_PAGE_SIZE}",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-200000",
+    "PRAGMA mmap_size=268435456",
+)
 
 
-def load_to_sqlite(records: list[dict], db_path: str):
+def ensure_page_size(cur: sqlite3.Cursor):
     """
-    Создаём две таблицы:
-      - documents: метаданные файлов
-      - documents_fts: виртуальная таблица FTS5 для полнотекстового поиска
+    page_size применяется к новой базе до первой записи, а к существующей —
+    только через VACUUM и не в режиме WAL. Поэтому старую базу один раз
+    переводим в DELETE, пересобираем, а WAL включат SQLITE_PRAGMAS.
     """
-    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
+    if cur.execute("PRAGMA page_size").fetchone()[0] == SQLITE_PAGE_SIZE:
+        return
+    if not cur.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone():
+        return
 
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS documents (
-            id            INTEGER PRIMARY KEY AUTOINCREMENT,
-            file_path     TEXT,
-            file_name     TEXT,
-            extension     TEXT,
-            size_bytes    INTEGER,
-            modified_at   TEXT,
-            source_archive TEXT,
-            content       TEXT,
-            file_hash     TEXT UNIQUE
-        )
-    """)
+    log.info(f"Пересобираем базу с page_size={SQLITE_PAGE_SIZE}")
+    cur.execute("PRAGMA journal_mode=DELETE")
+    cur.execute(f"PRAGMA page_size={SQLITE_PAGE_SIZE}")
+    cur.execute("VACUUM")
 
-    cur.execute("""
+
+def create_fts(cur: sqlite3.Cursor):
+    cur.execute(f"""
         CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
             file_name,
             content,
-            content='documents',
-            content_rowid='id'
+            tokenize={FTS_TOKENIZE},
+            prefix={FTS_PREFIX}
         )
     """)
 
-    inserted = 0
-    for r in records:
-        try:
-            cur.execute("""
+
+DOCUMENTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS documents (
+        id            INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_path     TEXT,
+        file_name     TEXT,
+        extension     TEXT,
+        size_bytes    INTEGER,
+        modified_at   TEXT,
+        source_archive TEXT,
+        file_hash     TEXT
+    )
+"""
+
+
+def create_schema(cur: sqlite3.Cursor):
+    """
+    Создаём таблицы, а базу старого формата переводим на текущую схему.
+    Старым считается формат, где есть хотя бы одно из:
+      - текст в documents.content;
+      - file_hash TEXT UNIQUE прямо в объявлении таблицы — такой автоиндекс
+        не удалить через DROP INDEX, и загрузка без индексов ему не помогает;
+      - external-content FTS или прежний токенизатор.
+    documents в этом случае пересоздаётся со всеми строками и прежними id,
+    текст переносится в documents_fts.
+    Строки с хэшем не по HASH_ALGORITHM сохраняются: кэш их не использует,
+    а load_to_sqlite заменяет их, когда файл с тем же путём обойдён заново.
+    """
+    cur.execute(DOCUMENTS_SCHEMA)
+
+    fts_sql = cur.execute(
+        "SELECT sql FROM sqlite_master WHERE name = 'documents_fts'"
+    ).fetchone()
+    has_content = any(
+        col[1] == "content" for col in cur.execute("PRAGMA table_info(documents)")
+    )
+    has_inline_unique = cur.execute("""
+        SELECT 1 FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = 'documents'
+          AND name LIKE 'sqlite_autoindex_documents_%'
+    """).fetchone() is not None
+    rebuild_documents = has_content or has_inline_unique
+    if not rebuild_documents and (fts_sql is None or FTS_TOKENIZE in fts_sql[0]):
+        create_fts(cur)
+        return
+
+    log.info("Переводим базу на новую схему")
+    columns = ", ".join(DOCUMENT_COLUMNS)
+    cur.execute("BEGIN IMMEDIATE")
+    if fts_sql:
+        cur.execute("ALTER TABLE documents_fts RENAME TO documents_fts_old")
+    if rebuild_documents:
+        cur.execute("DROP INDEX IF EXISTS ix_documents_hash")
+        cur.execute("DROP INDEX IF EXISTS ix_documents_path")
+        cur.execute("ALTER TABLE documents RENAME TO documents_old")
+        cur.execute(DOCUMENTS_SCHEMA)
+        # Переносим все строки с прежними id — по ним же documents_fts
+        # ниже получает текст. Индексы строим после копирования.
+        cur.execute(f"""
+            INSERT INTO documents(id, {columns})
+            SELECT id, {columns} FROM documents_old
+        """)
+        log.info(f"Перенесено документов: {cur.rowcount}")
+        legacy = cur.execute(
+            "SELECT COUNT(*) FROM documents WHERE length(file_hash) != ?",
+            (HASH_HEX_LENGTH,),
+        ).fetchone()[0]
+        if legacy:
+            log.warning(
+                f"В базе {legacy} документов с хэшем старого формата (MD5). "
+                f"Они остаются в поиске, но не в кэше; чтобы их заменить, "
+                f"заново обойдите каждую директорию, которую индексировали раньше"
+            )
+
+    create_fts(cur)
+    if has_content:
+        cur.execute("""
+            INSERT INTO documents_fts(rowid, file_name, content)
+            SELECT o.id, o.file_name, o.content
+            FROM documents_old o
+            JOIN documents d ON d.id = o.id
+        """)
+    else:
+        cur.execute("""
+            INSERT INTO documents_fts(rowid, file_name, content)
+            SELECT rowid, file_name, content FROM documents_fts_old
+            WHERE rowid IN (SELECT id FROM documents)
+        """)
+
+    if fts_sql:
+        cur.execute("DROP TABLE documents_fts_old")
+    if rebuild_documents:
+        cur.execute("DROP TABLE documents_old")
+        for index in SQLITE_INDEXES:
+            cur.execute(index)
+    cur.execute("COMMIT")
+    # Освобождаем место, которое занимали старая таблица и дублирующийся текст.
+    cur.execute("VACUUM")
+
+
+def open_db(db_path: str) -> sqlite3.Connection:
+    """Открываем базу на запись, заодно доводя её до текущих page_size и схемы."""
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    cur = conn.cursor()
+
+    ensure_page_size(cur)
+    for pragma in SQLITE_PRAGMAS:
+        cur.execute(pragma)
+
+    create_schema(cur)
+    return conn
+
+
+def load_to_sqlite(records: Iterable[dict], db_path: str):
+    """
+    Создаём две таблицы:
+      - documents: метаданные файлов
+      - documents_fts: таблица FTS5, которая хранит текст документов
+        (rowid совпадает с documents.id)
+
+    Все вставки идут одной транзакцией через executemany — без этого
+    каждая строка платит за собственный fsync. Записи читаются пачками
+    по SQLITE_BATCH_SIZE, так что на вход можно подавать генератор.
+    id назначаем сами (транзакция пишущая, MAX(id) никто не сдвинет),
+    чтобы сразу же вставить текст в documents_fts под тем же rowid.
+
+    В пустую базу грузим без индексов, потом убираем дубликаты по file_hash
+    и строим индексы один раз — это быстрее, чем обновлять B-дерево на каждой
+    вставке. В непустой базе индексы остаются на месте: перестраивать их
+    ради небольшой дозагрузки дороже.
+    """
+    conn = open_db(db_path)
+    cur = conn.cursor()
+
+    records = iter(records)
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        last_id = cur.execute("SELECT COALESCE(MAX(id), 0) FROM documents").fetchone()[0]
+        bulk = last_id == 0
+        if bulk:
+            cur.execute("DROP INDEX IF EXISTS ix_documents_hash")
+            cur.execute("DROP INDEX IF EXISTS ix_documents_path")
+        else:
+            for index in SQLITE_INDEXES:
+                cur.execute(index)
+
+        next_id = last_id + 1
+        while batch := list(itertools.islice(records, SQLITE_BATCH_SIZE)):
+            ids = range(next_id, next_id + len(batch))
+            next_id += len(batch)
+            cur.executemany("""
                 INSERT OR IGNORE INTO documents
-                    (file_path, file_name, extension, size_bytes,
-                     modified_at, source_archive, content, file_hash)
+                    (id, file_path, file_name, extension, size_bytes,
+                     modified_at, source_archive, file_hash)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                r["file_path"], r["file_name"], r["extension"],
-                r["size_bytes"], r["modified_at"], r["source_archive"],
-                r["content"], r["file_hash"],
-            ))
-            if cur.rowcount:
-                inserted += 1
-        except sqlite3.Error as e:
-            log.warning(f"Ошибка вставки {r['file_name']}: {e}")
-
-    cur.execute("INSERT INTO documents_fts(documents_fts) VALUES('rebuild')")
-
-    conn.commit()
+            """, [(i,) + document_row(r) for i, r in zip(ids, batch)])
+
+            # Вне bulk-режима уникальный индекс мог отбросить часть строк —
+            # их текст в FTS не кладём.
+            stored = None if bulk else {row[0] for row in cur.execute(
+                "SELECT id FROM documents WHERE id BETWEEN ? AND ?", (ids[0], ids[-1])
+            )}
+            cur.executemany(
+                "INSERT INTO documents_fts(rowid, file_name, content) VALUES (?, ?, ?)",
+                ((i, r["file_name"], r["content"]) for i, r in zip(ids, batch)
+                 if stored is None or i in stored),
+            )
+
+        # Строки со старым (MD5) хэшем у файлов, которые только что обойдены
+        # заново, заменяются новыми — иначе файл нашёлся бы в поиске дважды.
+        # Члены архивов старые версии записывали под путём во временной
+        # директории, поэтому их сопоставляем по архиву и имени файла.
+        legacy = [] if bulk else cur.execute("""
+            SELECT o.id
+            FROM documents n
+            JOIN documents o ON o.file_path = n.file_path
+            WHERE n.id > ?1 AND o.id <= ?1 AND length(o.file_hash) != ?2
+            UNION
+            SELECT o.id
+            FROM documents n
+            JOIN documents o ON o.source_archive = n.source_archive
+                            AND o.file_name = n.file_name
+            WHERE n.id > ?1 AND n.source_archive != ''
+              AND o.id <= ?1 AND length(o.file_hash) != ?2
+        """, (last_id, HASH_HEX_LENGTH)).fetchall()
+        if legacy:
+            cur.executemany("DELETE FROM documents WHERE id = ?", legacy)
+            cur.executemany("DELETE FROM documents_fts WHERE rowid = ?", legacy)
+            log.info(f"Заменено документов со старым хэшем: {len(legacy)}")
+
+        if bulk:
+            duplicates = cur.execute("""
+                SELECT id FROM documents WHERE id NOT IN (
+                    SELECT MIN(id) FROM documents GROUP BY file_hash
+                )
+            """).fetchall()
+            cur.executemany("DELETE FROM documents WHERE id = ?", duplicates)
+            cur.executemany("DELETE FROM documents_fts WHERE rowid = ?", duplicates)
+            for index in SQLITE_INDEXES:
+                cur.execute(index)
+
+        inserted = cur.execute(
+            "SELECT COUNT(*) FROM documents WHERE id > ?", (last_id,)
+        ).fetchone()[0]
+    except sqlite3.Error as e:
+        cur.execute("ROLLBACK")
+        conn.close()
+        log.error(f"Ошибка вставки в {db_path}: {e}")
+        raise
+    cur.execute("COMMIT")
+
     conn.close()
     log.info(f"SQLite база: {db_path} (добавлено {inserted} документов)")
 
@@ -301,18 +937,25 @@ def main():
     parser.add_argument("--root",   default="storage/", help="Корневая директория хранилища")
     parser.add_argument("--output", default="output/index.csv", help="Путь к итоговому CSV")
     parser.add_argument("--db",     default="output/fti.db",    help="Путь к SQLite базе")
+    parser.add_argument("--high-fidelity", action="store_true",
+                        help="Разбирать .pdf через pdfplumber (медленнее, точнее на сложной вёрстке)")
     args = parser.parse_args()
 
+    # Миграцию существующей базы проводим до краулинга: пока открыто
+    # соединение кэша, VACUUM и смена режима журнала упрутся в блокировку.
+    if os.path.exists(args.db):
+        open_db(args.db).close()
+
     log.info(f"Старт краулинга: {args.root}")
-    records = crawl_directory(args.root)
-    log.info(f"Всего документов найдено: {len(records)}")
+    records = crawl_directory(args.root, db_path=args.db, high_fidelity=args.high_fidelity)
 
-    if not records:
+    first = next(records, None)
+    if first is None:
         log.warning("Нет документов для обработки, выходим")
         return
 
-    save_csv(records, args.output)
-    load_to_sqlite(records, args.db)
+    records = itertools.chain([first], records)
+    load_to_sqlite(iter_csv(records, args.output), args.db)
     log.info("Готово!")
 
 
@@ -1,33 +1,65 @@
 import argparse
 import sqlite3
 import textwrap
+import threading
+
+
+SEARCH_SQL = """
+    SELECT
+        d.id,
+        d.file_name,
+        d.extension,
+        d.file_path,
+        d.source_archive,
+        d.size_bytes,
+        d.modified_at,
+        snippet(documents_fts, 1, '[', ']', '...', 20) AS snippet
+    FROM documents_fts
+    JOIN documents d ON d.id = documents_fts.rowid
+    WHERE documents_fts MATCH ?
+    ORDER BY rank
+    LIMIT ?
+"""
+
+
+class Searcher:
+    """
+    Держит соединение с базой открытым между запросами: PRAGMA выставляются
+    один раз, а sqlite3 переиспользует подготовленный SEARCH_SQL из своего
+    кэша выражений. Курсор — свой на каждый поток.
+    """
+
+    def __init__(self, db_path: str):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA mmap_size=1073741824")
+        self.conn.execute("PRAGMA cache_size=-100000")
+        self._local = threading.local()
+
+    def _cursor(self) -> sqlite3.Cursor:
+        cur = getattr(self._local, "cursor", None)
+        if cur is None:
+            cur = self._local.cursor = self.conn.cursor()
+        return cur
+
+    def search(self, query: str, limit: int = 10) -> list[dict]:
+        cur = self._cursor()
+        cur.execute(SEARCH_SQL, (query, limit))
+        return [dict(r) for r in cur.fetchall()]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self) -> "Searcher":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 def search(db_path: str, query: str, limit: int = 10) -> list[dict]:
-    conn = sqlite3.connect(db_path)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT
-            d.id,
-            d.file_name,
-            d.extension,
-            d.file_path,
-            d.source_archive,
-            d.size_bytes,
-            d.modified_at,
-            snippet(documents_fts, 1, '[', ']', '...', 20) AS snippet
-        FROM documents_fts
-        JOIN documents d ON d.id = documents_fts.rowid
-        WHERE documents_fts MATCH ?
-        ORDER BY rank
-        LIMIT ?
-    """, (query, limit))
-
-    rows = [dict(r) for r in cur.fetchall()]
-    conn.close()
-    return rows
+    with Searcher(db_path) as searcher:
+        return searcher.search(query, limit)
 
 
 def print_results(results: list[dict], query: str):